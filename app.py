@@ -1,8 +1,14 @@
 import streamlit as st
-from color import color_palette, ColorPalette
 from PIL import Image
 import numpy as np
-from resources import available_color_names, named_colors
+from resources import available_color_names
+from registry import SessionColors, palette_registry
+from gamut import (
+    gamut_coverage_report,
+    image_sample,
+    named_colors_sample,
+    srgb_sample,
+)
 import matplotlib.pyplot as plt
 import base64
 from io import BytesIO
@@ -60,6 +66,11 @@ if "selected_colors" not in st.session_state:
 if "custom_colors" not in st.session_state:
     st.session_state["custom_colors"] = []
 
+if "session_colors" not in st.session_state:
+    st.session_state["session_colors"] = SessionColors()
+
+session_colors = st.session_state["session_colors"]
+
 all_colors = available_color_names + st.session_state["custom_colors"]
 
 selected_colors = st.multiselect(
@@ -90,7 +101,7 @@ if st.button("Add Custom Color"):
         custom_rgb_tuple = tuple(
             int(custom_color_picker[i : i + 2], 16) for i in (1, 3, 5)
         )
-        named_colors[custom_color_name] = custom_rgb_tuple
+        session_colors.add_color(custom_color_name, custom_rgb_tuple)
         if custom_color_name not in st.session_state["selected_colors"]:
             st.session_state["selected_colors"].append(custom_color_name)
         if custom_color_name not in st.session_state["custom_colors"]:
@@ -101,7 +112,7 @@ if st.session_state["selected_colors"]:
     st.write("###")
     st.write("**Selected Colors:**")
     for color_name in st.session_state["selected_colors"]:
-        color_value = named_colors[color_name]
+        color_value = session_colors[color_name]
         color_hex = f"#{color_value[0]:02x}{color_value[1]:02x}{color_value[2]:02x}"
         st.markdown(
             f"<div style='display: flex; align-items: center;'>"
@@ -111,15 +122,50 @@ if st.session_state["selected_colors"]:
             unsafe_allow_html=True,
         )
 
-    selected_named_colors = {
-        name: named_colors[name] for name in st.session_state["selected_colors"]
-    }
-    color_palette_custom = ColorPalette(selected_named_colors)
+    color_palette_custom = palette_registry.get_palette(
+        st.session_state["selected_colors"], colors=session_colors
+    )
+
+    st.write("###")
+    st.write("**Gamut coverage target:**")
+    coverage_target = st.radio(
+        "Measure how well the palette reproduces:",
+        options=["Uniform sRGB sample", "Named colors", "Uploaded image"],
+        key="coverage_target",
+    )
+    if coverage_target == "Named colors":
+        coverage_color_names = st.multiselect(
+            "Target colors:", options=all_colors, default=all_colors
+        )
+    elif coverage_target == "Uploaded image":
+        coverage_file = st.file_uploader(
+            "Target image...", type=["jpg", "png", "jpeg"], key="coverage_file"
+        )
 
     if st.button("Submit Palette"):
         st.session_state["palette_submitted"] = True
         st.session_state["palette_image"] = visualize_palette(color_palette_custom)
 
+        st.session_state.pop("coverage_report", None)
+        target_rgb = None
+        if coverage_target == "Uniform sRGB sample":
+            target_rgb = srgb_sample()
+        elif coverage_target == "Named colors" and coverage_color_names:
+            target_rgb = named_colors_sample(
+                coverage_color_names, colors=session_colors
+            )
+        elif coverage_target == "Uploaded image" and coverage_file is not None:
+            target_rgb = image_sample(Image.open(coverage_file))
+
+        if target_rgb is None:
+            st.warning(
+                f"No target given for '{coverage_target}', the gamut coverage report was skipped."
+            )
+        else:
+            st.session_state["coverage_report"] = gamut_coverage_report(
+                color_palette_custom, target_rgb
+            )
+
 if st.session_state["palette_submitted"] and "palette_image" in st.session_state:
     st.write("### Color Palette Visualization")
 
@@ -143,6 +189,31 @@ if st.session_state["palette_submitted"] and "palette_image" in st.session_state
     """
     st.markdown(html_code, unsafe_allow_html=True)
 
+if st.session_state["palette_submitted"] and "coverage_report" in st.session_state:
+    coverage_report = st.session_state["coverage_report"]
+    st.write("### Gamut Coverage")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.write("**ΔE2000 error percentiles:**")
+        for percentile, error in coverage_report.percentiles.items():
+            st.write(f"p{percentile}: {error:.2f}")
+    with col2:
+        st.write("**Fraction of the target within:**")
+        for threshold, fraction in coverage_report.fractions_within.items():
+            st.write(f"ΔE <= {threshold}: {fraction:.1%}")
+
+    if coverage_report.sample_indices is not None:
+        st.caption(
+            f"The target has many distinct colors, so these statistics are estimated from a random sample of "
+            f"{coverage_report.sample_size:,} of its {np.prod(coverage_report.target_shape):,} pixels."
+        )
+
+    st.image(
+        coverage_report.heatmap(),
+        caption="Mean ΔE2000 over the a*b* plane, bright regions are poorly covered",
+    )
+
 if st.session_state["palette_submitted"]:
     st.write("###")
     st.write("## Pick a color:")
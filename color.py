@@ -1,8 +1,8 @@
 import mixbox
 import numpy as np
+from types import MappingProxyType
 import colorspacious as cs
 import matplotlib.pyplot as plt
-import numpy as np
 from colormath.color_objects import LabColor
 from colormath.color_diff import delta_e_cie2000
 from resources import named_colors, available_color_names
@@ -67,12 +67,191 @@ def rgb_distance(rgb1, rgb2):
     return lab_distance(lab1, lab2)
 
 
+def rgb_array_to_lab(rgb_array):
+    """
+    Convert an array of RGB colors to LAB color space.
+
+    Args:
+    rgb_array (np.ndarray): An array of shape (..., 3) with values in range [0, 255].
+
+    Returns:
+    np.ndarray: A float array of shape (..., 3) of (L*, a*, b*) values.
+    """
+    rgb_array = np.asarray(rgb_array, dtype=np.float64)
+    return cs.cspace_convert(rgb_array, "sRGB255", "CIELab")
+
+
+def lab_array_to_rgb(lab_array):
+    """
+    Convert an array of LAB colors to RGB color space.
+
+    Args:
+    lab_array (np.ndarray): An array of shape (..., 3) of (L*, a*, b*) values.
+
+    Returns:
+    np.ndarray: A uint8 array of shape (..., 3) with values clipped to range [0, 255].
+    """
+    rgb_array = cs.cspace_convert(
+        np.asarray(lab_array, dtype=np.float64), "CIELab", "sRGB255"
+    )
+    return np.clip(np.round(rgb_array), 0, 255).astype(np.uint8)
+
+
+def lab_distance_array(lab1, lab2):
+    """
+    Calculate the Delta E 2000 distance between two arrays of LAB colors.
+    This is a vectorized version of lab_distance, the arrays are broadcast against each other.
+
+    Args:
+    lab1 (np.ndarray): An array of shape (..., 3) of (L*, a*, b*) values.
+    lab2 (np.ndarray): An array of shape (..., 3) of (L*, a*, b*) values.
+
+    Returns:
+    np.ndarray: The Delta E 2000 distances, with the broadcast shape of the inputs without the last axis.
+    """
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    # chroma compensation of the a* axis
+    C_bar = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+    C_bar_7 = C_bar**7
+    G = 0.5 * (1 - np.sqrt(C_bar_7 / (C_bar_7 + 25.0**7)))
+    a1_p = (1 + G) * a1
+    a2_p = (1 + G) * a2
+    C1_p = np.hypot(a1_p, b1)
+    C2_p = np.hypot(a2_p, b2)
+    h1_p = np.degrees(np.arctan2(b1, a1_p)) % 360
+    h2_p = np.degrees(np.arctan2(b2, a2_p)) % 360
+    achromatic = C1_p * C2_p == 0
+
+    # differences in lightness, chroma and hue
+    delta_L_p = L2 - L1
+    delta_C_p = C2_p - C1_p
+    delta_h_p = h2_p - h1_p
+    delta_h_p = np.where(delta_h_p > 180, delta_h_p - 360, delta_h_p)
+    delta_h_p = np.where(delta_h_p < -180, delta_h_p + 360, delta_h_p)
+    delta_h_p = np.where(achromatic, 0, delta_h_p)
+    delta_H_p = 2 * np.sqrt(C1_p * C2_p) * np.sin(np.radians(delta_h_p / 2))
+
+    # means in lightness, chroma and hue
+    L_bar_p = (L1 + L2) / 2
+    C_bar_p = (C1_p + C2_p) / 2
+    h_sum = h1_p + h2_p
+    h_bar_p = np.where(
+        np.abs(h1_p - h2_p) > 180,
+        np.where(h_sum < 360, (h_sum + 360) / 2, (h_sum - 360) / 2),
+        h_sum / 2,
+    )
+    h_bar_p = np.where(achromatic, h_sum, h_bar_p)
+
+    # weighting functions
+    T = (
+        1
+        - 0.17 * np.cos(np.radians(h_bar_p - 30))
+        + 0.24 * np.cos(np.radians(2 * h_bar_p))
+        + 0.32 * np.cos(np.radians(3 * h_bar_p + 6))
+        - 0.20 * np.cos(np.radians(4 * h_bar_p - 63))
+    )
+    delta_theta = 30 * np.exp(-(((h_bar_p - 275) / 25) ** 2))
+    C_bar_p_7 = C_bar_p**7
+    R_C = 2 * np.sqrt(C_bar_p_7 / (C_bar_p_7 + 25.0**7))
+    S_L = 1 + (0.015 * (L_bar_p - 50) ** 2) / np.sqrt(20 + (L_bar_p - 50) ** 2)
+    S_C = 1 + 0.045 * C_bar_p
+    S_H = 1 + 0.015 * C_bar_p * T
+    R_T = -np.sin(np.radians(2 * delta_theta)) * R_C
+
+    delta_L = delta_L_p / S_L
+    delta_C = delta_C_p / S_C
+    delta_H = delta_H_p / S_H
+    return np.sqrt(delta_L**2 + delta_C**2 + delta_H**2 + R_T * delta_C * delta_H)
+
+
+DEFAULT_MEMORY_BUDGET = 64 * 2**20
+
+# approximate peak bytes of intermediate arrays, measured with tracemalloc, used to size the chunks of search_colors:
+# per pair of colors in lab_distance_array including the gathered inputs, per pair of colors in
+# _delta_e_lower_bound_squared and the pruning around it, per pair of colors in the euclidean candidate search
+# and per color converted by rgb_array_to_lab
+_DELTA_E_PAIR_BYTES = 320
+_LOWER_BOUND_PAIR_BYTES = 96
+_SEARCH_PAIR_BYTES = 24
+_CONVERSION_ROW_BYTES = 256
+
+
+def _lab_to_search_space(lab_array):
+    """Map LAB colors to a space where euclidean distance is a cheap approximation of Delta E 2000.
+    Delta E 2000 discounts chroma differences between saturated colors, so the chroma is compressed
+    in the same way as its chroma weighting function S_C = 1 + 0.045 * C."""
+    lab_array = np.asarray(lab_array, dtype=np.float64)
+    chroma = np.hypot(lab_array[..., 1], lab_array[..., 2])
+    scale = np.log1p(0.045 * chroma) / 0.045 / np.maximum(chroma, 1e-12)
+    search_array = np.empty(lab_array.shape, dtype=np.float32)
+    search_array[..., 0] = lab_array[..., 0]
+    search_array[..., 1] = lab_array[..., 1] * scale
+    search_array[..., 2] = lab_array[..., 2] * scale
+    return search_array
+
+
+def _delta_e_lower_bound_squared(lab1, lab2):
+    """Return an (M, N) array of lower bounds on the squared Delta E 2000 distance between each of the M colors
+    in lab1 and each of the N colors in lab2, which is several times cheaper to compute than the distance itself.
+
+    With x, y and z the weighted lightness, chroma and hue differences, Delta E 2000 squared is
+    x^2 + y^2 + z^2 + R_T * y * z >= x^2 + (1 - |R_T| / 2) * (y^2 + z^2) and |R_T| <= sqrt(3).
+    Since S_H <= S_C, y^2 + z^2 >= |(a1', b1) - (a2', b2)|^2 / S_C^2, and since 0 <= G <= 0.5, the a*b* distance
+    is at least |(a1, b1) - (a2, b2)| and S_C is at most 1 + 0.045 * 1.5 * C_bar.
+    """
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    L1, a1, b1 = lab1[:, None, 0], lab1[:, None, 1], lab1[:, None, 2]
+    L2, a2, b2 = lab2[None, :, 0], lab2[None, :, 1], lab2[None, :, 2]
+
+    # chroma and hue term, computed in place to keep the number of (M, N) temporaries low
+    bound = np.square(a1 - a2)
+    bound += np.square(b1 - b2)
+    S_C = np.hypot(a1, b1) + np.hypot(a2, b2)
+    S_C *= 0.045 * 1.5 / 2
+    S_C += 1
+    S_C **= 2
+    bound /= S_C
+    bound *= 1 - np.sqrt(3) / 2
+    del S_C
+
+    # lightness term
+    L_bar_p = L1 + L2
+    L_bar_p /= 2
+    L_bar_p -= 50
+    L_bar_p **= 2
+    S_L = L_bar_p + 20
+    np.sqrt(S_L, out=S_L)
+    np.divide(L_bar_p, S_L, out=S_L)
+    S_L *= 0.015
+    S_L += 1
+    delta_L = L1 - L2
+    delta_L /= S_L
+    delta_L **= 2
+    bound += delta_L
+    return bound
+
+
+def _top_k_pairs(rows, cols, delta_e, num_rows, k):
+    """Return the (num_rows, k) cols and delta_e of the k pairs with the smallest delta_e in each row,
+    closest first and lowest col first among equal distances. Every row must have at least k pairs."""
+    order = np.lexsort((cols, delta_e, rows))
+    starts = np.searchsorted(rows[order], np.arange(num_rows))
+    best = order[starts[:, None] + np.arange(k)]
+    return cols[best], delta_e[best]
+
+
 class Color:
     """A color class. This class represents the mixing tree leading to the specified color.
     === Class Attributes ===
     - rgb: The RGB value of the color as a tuple (r, g, b)
     - parents: a list of doubles [(p, a), ...] where p is a Color object and a is the proportion of p in the mixture
         If parents is an empty list that means that the Color object is a source color
+        It is a tuple once the palette containing the color is frozen
     - name: the name of the color
     """
 
@@ -118,25 +297,31 @@ class ColorPalette:
     - refinement_level: the number of interpolation steps between each color in the palette
     - source_colors: a list of Color objects representing the source colors
     - rgb_to_color: a dictionary mapping RGB values to Color objects
+    - colors: a list of the Color objects in the palette, in the same order as rgb_to_color
+    - rgb_array: an (N, 3) float array of the RGB values of colors
+    - lab_array: an (N, 3) float array of the LAB values of colors
+    - frozen: whether the palette has been made read-only so that it can be shared between threads
     """
 
-    def __init__(self, source_colors_names, refinement_level=8):
-        """Initialize a new color palette with the given source colors."""
+    def __init__(self, source_colors_names, refinement_level=8, colors=None):
+        """Initialize a new color palette with the given source colors.
+        The RGB values of the source colors are looked up in colors, which defaults to named_colors."""
+        if colors is None:
+            colors = named_colors
+
         self.refinement_level = refinement_level
         self.source_colors = []
         self.rgb_to_color = {}
+        self.frozen = False
 
-        # first get all the keys from named_colors
-        named_colors_keys = list(named_colors.keys())
-
-        # assert that the source colors are in named_colors
+        # assert that the source colors are in colors
         for color_name in source_colors_names:
             assert (
-                color_name in named_colors_keys
+                color_name in colors
             ), f"Proposed source color named {color_name} is not in named_colors"
 
         for source_color_name in source_colors_names:
-            source_color_rgb = named_colors[source_color_name]
+            source_color_rgb = tuple(colors[source_color_name])
             source_color = Color(rgb=source_color_rgb, name=source_color_name)
             self.source_colors.append(source_color)
             self.rgb_to_color[source_color_rgb] = source_color
@@ -150,24 +335,144 @@ class ColorPalette:
                     new_color = color1.mix(color2, proportion)
                     self.rgb_to_color[new_color.rgb] = new_color
 
+        self.colors = list(self.rgb_to_color.values())
+        self.rgb_array = np.array(list(self.rgb_to_color.keys()), dtype=np.float64)
+        self.lab_array = rgb_array_to_lab(self.rgb_array)
+
+    def freeze(self):
+        """Make the palette read-only, so that it can be shared between threads without copying.
+        The recipes of its colors are frozen too, so that add_parent fails on them."""
+        for color in (*self.source_colors, *self.colors):
+            color.parents = tuple(color.parents)
+        self.rgb_to_color = MappingProxyType(self.rgb_to_color)
+        self.source_colors = tuple(self.source_colors)
+        self.colors = tuple(self.colors)
+        self.rgb_array.flags.writeable = False
+        self.lab_array.flags.writeable = False
+        self.frozen = True
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["rgb_to_color"] = dict(self.rgb_to_color)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.frozen:
+            self.freeze()
+
+    def search_colors(
+        self,
+        rgb_array,
+        k=1,
+        approximate=False,
+        num_candidates=32,
+        memory_budget=DEFAULT_MEMORY_BUDGET,
+    ):
+        """
+        Return the k closest palette colors by Delta E 2000 to each of the given RGB values.
+
+        Delta E 2000 is too expensive to evaluate against the whole palette for many colors, so for each color
+        the num_candidates closest palette colors in _lab_to_search_space are ranked first. Unless approximate
+        is set, every other palette color whose _delta_e_lower_bound_squared does not rule it out is ranked too,
+        so the result is the same as ranking the whole palette. With approximate set only the candidates are
+        ranked, which is faster but can miss the closest color, mostly for colors far from the palette.
+        The colors are processed in chunks small enough for the intermediate arrays to fit in memory_budget.
+        All the work is done in NumPy, which releases the GIL, so large queries can be split across threads.
+
+        Args:
+        rgb_array (np.ndarray): An (M, 3) uint8 or float array of RGB values in range [0, 255].
+        k (int): The number of matches to return for each color.
+        approximate (bool): Whether to only rank the num_candidates candidates of each color.
+        num_candidates (int): The number of candidates ranked first for each color, None for the whole palette.
+        memory_budget (int): The approximate number of bytes of intermediate arrays allowed at once.
+
+        Returns:
+        tuple: An (M, k) int array of indices into colors, closest first, and an (M, k) float array
+        of the Delta E 2000 distances to them. Use get_colors to turn the indices into Color objects.
+        """
+        rgb_array = np.asarray(rgb_array).reshape(-1, 3)
+        num_colors = len(self.colors)
+        assert 1 <= k <= num_colors, f"k must be between 1 and {num_colors}"
+        if num_candidates is None:
+            num_candidates = num_colors
+        num_candidates = min(max(num_candidates, k), num_colors)
+        prune = num_candidates < num_colors and not approximate
+
+        row_bytes = _CONVERSION_ROW_BYTES + num_candidates * _DELTA_E_PAIR_BYTES
+        if num_candidates < num_colors:
+            row_bytes += num_colors * _SEARCH_PAIR_BYTES
+            search_array = _lab_to_search_space(self.lab_array)
+            squared_norms = np.einsum("ij,ij->i", search_array, search_array)
+        if prune:
+            row_bytes += num_colors * _LOWER_BOUND_PAIR_BYTES
+        chunk_size = max(1, int(memory_budget // row_bytes))
+        pair_chunk_size = max(1, int(memory_budget // _DELTA_E_PAIR_BYTES))
+
+        indices = np.empty((len(rgb_array), k), dtype=np.intp)
+        distances = np.empty((len(rgb_array), k), dtype=np.float64)
+
+        for start in range(0, len(rgb_array), chunk_size):
+            chunk = rgb_array_to_lab(rgb_array[start : start + chunk_size])
+            chunk_rows = np.arange(len(chunk))
+            if num_candidates == num_colors:
+                candidates = np.broadcast_to(
+                    np.arange(num_colors), (len(chunk), num_colors)
+                )
+            else:
+                # squared euclidean distance up to a per row constant
+                euclidean = _lab_to_search_space(chunk) @ search_array.T
+                euclidean *= -2
+                euclidean += squared_norms
+                candidates = np.argpartition(euclidean, num_candidates - 1, axis=1)
+                del euclidean
+                candidates = candidates[:, :num_candidates].copy()
+
+            delta_e = lab_distance_array(chunk[:, None, :], self.lab_array[candidates])
+            rows = np.repeat(chunk_rows, num_candidates)
+            cols = candidates.ravel()
+            delta_e = delta_e.ravel()
+
+            if prune:
+                # only palette colors that could be closer than the k-th closest candidate need to be ranked
+                threshold = np.partition(delta_e.reshape(-1, num_candidates), k - 1)
+                threshold = threshold[:, k - 1] + 1e-6
+                unresolved = _delta_e_lower_bound_squared(chunk, self.lab_array)
+                unresolved = unresolved <= np.square(threshold)[:, None]
+                unresolved[chunk_rows[:, None], candidates] = False
+                extra_rows, extra_cols = np.nonzero(unresolved)
+                del unresolved
+
+                extra_delta_e = np.empty(len(extra_rows), dtype=np.float64)
+                for pair_start in range(0, len(extra_rows), pair_chunk_size):
+                    pair_end = pair_start + pair_chunk_size
+                    extra_delta_e[pair_start:pair_end] = lab_distance_array(
+                        chunk[extra_rows[pair_start:pair_end]],
+                        self.lab_array[extra_cols[pair_start:pair_end]],
+                    )
+                rows = np.concatenate([rows, extra_rows])
+                cols = np.concatenate([cols, extra_cols])
+                delta_e = np.concatenate([delta_e, extra_delta_e])
+
+            (
+                indices[start : start + chunk_size],
+                distances[start : start + chunk_size],
+            ) = _top_k_pairs(rows, cols, delta_e, len(chunk), k)
+
+        return indices, distances
+
+    def get_colors(self, indices):
+        """Return the Color objects at the given indices into colors, as nested lists of the same shape as indices."""
+        indices = np.asarray(indices)
+        if indices.ndim == 0:
+            return self.colors[indices]
+        return [self.get_colors(index) for index in indices]
+
     def search_color(self, rgb):
         """Return the Color object with rgb value closest to the given rgb value."""
-
-        closest_color = None
-        closest_distance = float("inf")
-
-        for color_rgb in self.rgb_to_color:
-            distance = rgb_distance(color_rgb, rgb)
-            if distance < closest_distance:
-                closest_distance = distance
-                closest_color = self.rgb_to_color[color_rgb]
-
-        return closest_color
-
-
-color_palette = ColorPalette(
-    source_colors_names=available_color_names, refinement_level=10
-)
+        indices, _ = self.search_colors([rgb])
+        return self.colors[indices[0, 0]]
 
 
 def visualize_palette(color_palette, filename="color_palette.png"):
@@ -218,5 +523,9 @@ def visualize_palette(color_palette, filename="color_palette.png"):
     plt.close()
 
 
-# Example usage:
-visualize_palette(color_palette)
+if __name__ == "__main__":
+    # Example usage:
+    color_palette = ColorPalette(
+        source_colors_names=available_color_names, refinement_level=10
+    )
+    visualize_palette(color_palette)
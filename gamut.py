@@ -0,0 +1,242 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from io import BytesIO
+from color import rgb_array_to_lab
+from resources import named_colors
+
+DEFAULT_PERCENTILES = (50, 75, 90, 95, 99)
+DEFAULT_THRESHOLDS = (1.0, 2.0, 5.0, 10.0)
+DEFAULT_MAX_COLORS = 2**14
+DEFAULT_NUM_SAMPLES = 100000
+
+
+def srgb_sample(steps=24):
+    """
+    Return a uniform grid sample of the sRGB cube.
+
+    Args:
+    steps (int): The number of samples along each of the R, G and B axes.
+
+    Returns:
+    np.ndarray: A uint8 array of shape (steps ** 3, 3).
+    """
+    axis = np.linspace(0, 255, steps).round().astype(np.uint8)
+    r, g, b = np.meshgrid(axis, axis, axis, indexing="ij")
+    return np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+
+
+def named_colors_sample(color_names, colors=named_colors):
+    """
+    Return the RGB values of a set of named colors.
+
+    Args:
+    color_names (list): The names of the colors, all of which must be in colors.
+    colors (dict): A dictionary mapping color names to RGB tuples.
+
+    Returns:
+    np.ndarray: A uint8 array of shape (len(color_names), 3).
+    """
+    for color_name in color_names:
+        assert color_name in colors, f"Target color named {color_name} is not in colors"
+    return np.array([colors[name] for name in color_names], dtype=np.uint8).reshape(
+        -1, 3
+    )
+
+
+def image_sample(image):
+    """
+    Return the pixels of an image as an array of RGB values, keeping the image shape.
+
+    Args:
+    image (PIL.Image.Image or np.ndarray): The image, any alpha channel is dropped.
+
+    Returns:
+    np.ndarray: A uint8 array of shape (height, width, 3).
+    """
+    if not isinstance(image, np.ndarray):
+        image = np.asarray(image.convert("RGB"))
+    return np.asarray(image, dtype=np.uint8)[..., :3]
+
+
+def unique_colors(rgb_array):
+    """Return the unique rows of a uint8 (M, 3) array, the index of each row into the unique rows and the
+    number of occurrences of each unique row. Packing the rows into integers is much faster than np.unique(axis=0).
+    """
+    rgb_array = np.asarray(rgb_array, dtype=np.uint8).reshape(-1, 3)
+    packed = (
+        (rgb_array[:, 0].astype(np.uint32) << 16)
+        | (rgb_array[:, 1].astype(np.uint32) << 8)
+        | rgb_array[:, 2].astype(np.uint32)
+    )
+    unique_packed, inverse, counts = np.unique(
+        packed, return_inverse=True, return_counts=True
+    )
+    unique_rgb = np.stack(
+        [
+            (unique_packed >> 16) & 0xFF,
+            (unique_packed >> 8) & 0xFF,
+            unique_packed & 0xFF,
+        ],
+        axis=1,
+    ).astype(np.uint8)
+    return unique_rgb, inverse.ravel(), counts
+
+
+def _weighted_percentiles(values, weights, percentiles):
+    """Return the given percentiles of values where each value is counted weights times."""
+    order = np.argsort(values)
+    cumulative_weights = np.cumsum(weights[order])
+    positions = np.asarray(percentiles, dtype=np.float64) / 100 * cumulative_weights[-1]
+    ranks = np.searchsorted(cumulative_weights, positions, side="left")
+    ranks = np.clip(ranks, 0, len(values) - 1)
+    return values[order][ranks]
+
+
+class CoverageReport:
+    """A CoverageReport class. This class represents how well a color palette can reproduce a target set of colors.
+    === Class Attributes ===
+    - target_rgb: a uint8 (U, 3) array of the unique colors in the target, or in the sample of it
+    - target_lab: a float (U, 3) array of the LAB values of target_rgb
+    - counts: an int (U,) array of how many times each unique color occurs in the target, or in the sample of it
+    - indices: an int (U,) array of the index into color_palette.colors of the closest match of each unique color
+    - delta_e: a float (U,) array of the Delta E 2000 distance of each unique color to its closest match
+    - percentiles: a dictionary mapping percentiles to the Delta E 2000 error at that percentile of the target
+    - fractions_within: a dictionary mapping Delta E 2000 thresholds to the fraction of the target within them
+    - target_shape: the shape of the target without the color axis, e.g. (height, width) for an image
+    - inverse: an int array mapping each sampled target color to its row in target_rgb
+    - sample_indices: an int array of the flat indices of the sampled target colors, None if all of them were used
+    - sample_size: the number of target colors the statistics were computed from
+    """
+
+    def __init__(
+        self,
+        color_palette,
+        target_rgb,
+        percentiles=DEFAULT_PERCENTILES,
+        thresholds=DEFAULT_THRESHOLDS,
+        max_colors=DEFAULT_MAX_COLORS,
+        num_samples=DEFAULT_NUM_SAMPLES,
+        seed=0,
+    ):
+        """Initialize a new coverage report of color_palette against target_rgb, an array of shape (..., 3)
+        of RGB values in range [0, 255].
+        Matching is exact but costs time per distinct color, so for targets with more than max_colors distinct colors,
+        such as photographs, the statistics are estimated from num_samples target colors drawn at random with seed.
+        The sampled colors are matched exactly, so the estimates are unbiased."""
+        target_rgb = np.asarray(target_rgb)
+        assert target_rgb.shape[-1] == 3, "Target colors must have shape (..., 3)"
+        assert target_rgb.size > 0, "Target must contain at least one color"
+        if target_rgb.dtype != np.uint8:
+            assert (
+                np.isfinite(target_rgb).all()
+                and ((target_rgb >= 0) & (target_rgb <= 255)).all()
+            ), "RGB values must be in range [0, 255]"
+            target_rgb = np.round(target_rgb).astype(np.uint8)
+        self.target_shape = target_rgb.shape[:-1]
+        target_rgb = target_rgb.reshape(-1, 3)
+
+        # images and grids repeat colors a lot, so only match each distinct color once
+        self.target_rgb, self.inverse, self.counts = unique_colors(target_rgb)
+        self.sample_indices = None
+        if len(self.target_rgb) > max_colors and len(target_rgb) > num_samples:
+            rng = np.random.default_rng(seed)
+            self.sample_indices = np.sort(
+                rng.choice(len(target_rgb), num_samples, replace=False)
+            )
+            self.target_rgb, self.inverse, self.counts = unique_colors(
+                target_rgb[self.sample_indices]
+            )
+        self.sample_size = int(self.counts.sum())
+        self.target_lab = rgb_array_to_lab(self.target_rgb)
+        indices, delta_e = color_palette.search_colors(self.target_rgb)
+        self.indices = indices[:, 0]
+        self.delta_e = delta_e[:, 0]
+
+        total = self.sample_size
+        self.percentiles = dict(
+            zip(
+                percentiles,
+                _weighted_percentiles(self.delta_e, self.counts, percentiles),
+            )
+        )
+        self.fractions_within = {
+            threshold: self.counts[self.delta_e <= threshold].sum() / total
+            for threshold in thresholds
+        }
+
+    def error_map(self):
+        """Return the Delta E 2000 error of every target color, in the shape of the target.
+        If the target was sampled, the colors outside of the sample are NaN."""
+        if self.sample_indices is None:
+            return self.delta_e[self.inverse].reshape(self.target_shape)
+        errors = np.full(int(np.prod(self.target_shape)), np.nan)
+        errors[self.sample_indices] = self.delta_e[self.inverse]
+        return errors.reshape(self.target_shape)
+
+    def heatmap(self, bins=48, vmax=None):
+        """Return a PNG image of the mean Delta E 2000 error of the target over the a*b* plane,
+        so that poorly covered hues and chromas show up as hot regions."""
+        a = self.target_lab[:, 1]
+        b = self.target_lab[:, 2]
+        limit = max(np.abs(a).max(), np.abs(b).max(), 1.0)
+        extent = [[-limit, limit], [-limit, limit]]
+
+        error_sums, a_edges, b_edges = np.histogram2d(
+            a, b, bins=bins, range=extent, weights=self.delta_e * self.counts
+        )
+        count_sums, _, _ = np.histogram2d(
+            a, b, bins=bins, range=extent, weights=self.counts
+        )
+        with np.errstate(invalid="ignore"):
+            mean_errors = error_sums / count_sums
+
+        fig, ax = plt.subplots(figsize=(6, 5))
+        mesh = ax.pcolormesh(
+            a_edges, b_edges, mean_errors.T, cmap="inferno", vmin=0, vmax=vmax
+        )
+        fig.colorbar(mesh, ax=ax, label="Mean ΔE2000")
+        ax.set_xlabel("a*")
+        ax.set_ylabel("b*")
+        ax.set_aspect("equal")
+
+        buf = BytesIO()
+        plt.savefig(buf, format="png", bbox_inches="tight")
+        plt.close(fig)
+        buf.seek(0)
+
+        return buf
+
+    def __str__(self) -> str:
+        percentiles_str = ", ".join(
+            [f"p{p}: {error:.2f}" for p, error in self.percentiles.items()]
+        )
+        fractions_str = ", ".join(
+            [
+                f"ΔE <= {threshold}: {fraction:.1%}"
+                for threshold, fraction in self.fractions_within.items()
+            ]
+        )
+        return f"ΔE2000 percentiles: {percentiles_str}. Coverage: {fractions_str}."
+
+
+def gamut_coverage_report(
+    color_palette,
+    target_rgb=None,
+    percentiles=DEFAULT_PERCENTILES,
+    thresholds=DEFAULT_THRESHOLDS,
+    max_colors=DEFAULT_MAX_COLORS,
+    num_samples=DEFAULT_NUM_SAMPLES,
+    seed=0,
+):
+    """Return a CoverageReport of how well color_palette reproduces target_rgb, by default a uniform sample of sRGB."""
+    if target_rgb is None:
+        target_rgb = srgb_sample()
+    return CoverageReport(
+        color_palette,
+        target_rgb,
+        percentiles=percentiles,
+        thresholds=thresholds,
+        max_colors=max_colors,
+        num_samples=num_samples,
+        seed=seed,
+    )
@@ -0,0 +1,119 @@
+import threading
+from collections import ChainMap, OrderedDict
+from types import MappingProxyType
+from color import ColorPalette
+from resources import named_colors
+
+
+class SessionColors(ChainMap):
+    """A SessionColors class. This class represents the colors available to a single user session.
+    Reads fall through to the shared named_colors, while custom colors are written to an overlay
+    owned by the session, so sessions never see each other's custom colors.
+    === Class Attributes ===
+    - custom_colors: a dictionary mapping the names of the custom colors of the session to RGB tuples
+    """
+
+    def __init__(self, base_colors=named_colors):
+        """Initialize a new empty overlay over base_colors, which is never written to."""
+        super().__init__({}, MappingProxyType(base_colors))
+
+    @property
+    def custom_colors(self):
+        return self.maps[0]
+
+    def add_color(self, name, rgb):
+        """Add a custom color to this session, shadowing any shared color with the same name."""
+        self.custom_colors[name] = tuple(int(channel) for channel in rgb)
+
+
+def palette_key(source_colors_names, refinement_level=8, colors=None):
+    """Return the key identifying the palette built from the given source colors.
+    The key is made from the RGB values rather than just the names, so that custom colors with the same
+    name in different sessions do not share a palette, and it does not depend on the selection order.
+    """
+    if colors is None:
+        colors = named_colors
+    for color_name in source_colors_names:
+        assert (
+            color_name in colors
+        ), f"Proposed source color named {color_name} is not in named_colors"
+    source_colors = sorted(
+        (name, tuple(colors[name])) for name in set(source_colors_names)
+    )
+    return (refinement_level, tuple(source_colors))
+
+
+class PaletteRegistry:
+    """A PaletteRegistry class. This class is a process-wide cache of built color palettes.
+    Palettes are frozen once built and shared between all threads and sessions asking for the same source colors.
+    It is safe to use from multiple threads, and each palette is only built once even if requested concurrently.
+    === Class Attributes ===
+    - max_palettes: the maximum number of palettes kept, the least recently used palette is dropped first
+    """
+
+    def __init__(self, max_palettes=32):
+        """Initialize a new empty registry."""
+        self.max_palettes = max_palettes
+        self._palettes = OrderedDict()
+        self._build_locks = {}
+        self._lock = threading.Lock()
+
+    def get_palette(self, source_colors_names, refinement_level=8, colors=None):
+        """Return the frozen ColorPalette for the given source colors, building it if it is not cached.
+        The RGB values of the source colors are looked up in colors, which defaults to named_colors.
+        """
+        key = palette_key(source_colors_names, refinement_level, colors)
+
+        while True:
+            with self._lock:
+                if key in self._palettes:
+                    self._palettes.move_to_end(key)
+                    return self._palettes[key]
+                build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+            # build outside of the registry lock so that other palettes can be served meanwhile
+            with build_lock:
+                with self._lock:
+                    if key in self._palettes:
+                        self._palettes.move_to_end(key)
+                        return self._palettes[key]
+                    if self._build_locks.get(key) is not build_lock:
+                        # the build waited for failed and dropped its lock, queue behind the current build instead
+                        continue
+
+                refinement_level, source_colors = key
+                try:
+                    palette = ColorPalette(
+                        [name for name, _ in source_colors],
+                        refinement_level=refinement_level,
+                        colors=dict(source_colors),
+                    ).freeze()
+
+                    with self._lock:
+                        self._palettes[key] = palette
+                        while len(self._palettes) > self.max_palettes:
+                            self._palettes.popitem(last=False)
+                finally:
+                    # also forget the lock of a failed build, so that bad requests do not pile up locks,
+                    # but never a newer lock another thread is building under
+                    with self._lock:
+                        if self._build_locks.get(key) is build_lock:
+                            del self._build_locks[key]
+
+            return palette
+
+    def clear(self):
+        """Remove all palettes from the registry."""
+        with self._lock:
+            self._palettes.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._palettes)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._palettes
+
+
+palette_registry = PaletteRegistry()
@@ -0,0 +1,422 @@
+import argparse
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from registry import SessionColors, palette_registry
+
+# palettes grow with the square of the number of source colors times the refinement level,
+# so requests are limited to palettes that build in well under a second
+MAX_REFINEMENT_LEVEL = 32
+MAX_SOURCE_COLORS = 64
+
+
+def color_to_json(color):
+    """Return a JSON serializable description of a Color object and its recipe."""
+    return {
+        "name": color.name,
+        "rgb": [int(channel) for channel in color.rgb],
+        "description": str(color),
+        "parents": [
+            {
+                "name": parent.name,
+                "rgb": [int(channel) for channel in parent.rgb],
+                "proportion": proportion,
+            }
+            for parent, proportion in color.parents
+        ],
+    }
+
+
+class ServerStats:
+    """A ServerStats class. This class collects latency and throughput statistics of the matching service.
+    It is safe to use from multiple threads.
+    === Class Attributes ===
+    - start_time: the time the statistics were started at
+    - num_requests: the number of match requests served
+    - num_matched: the number of colors matched over all requests
+    - num_batches: the number of micro-batches the requests were coalesced into
+    - failures: a dictionary mapping HTTP status codes to the number of requests that failed with them
+    - latencies: the latencies in seconds of the most recent requests
+    """
+
+    def __init__(self, max_latencies=10000):
+        """Initialize new empty statistics, keeping the latencies of the last max_latencies requests."""
+        self.start_time = time.perf_counter()
+        self.num_requests = 0
+        self.num_matched = 0
+        self.num_batches = 0
+        self.failures = {}
+        self.latencies = deque(maxlen=max_latencies)
+        self._lock = threading.Lock()
+
+    def record_request(self, num_colors, latency):
+        """Record a served request matching num_colors colors in latency seconds."""
+        with self._lock:
+            self.num_requests += 1
+            self.num_matched += num_colors
+            self.latencies.append(latency)
+
+    def record_failure(self, status):
+        """Record a request failing with the HTTP status code status."""
+        with self._lock:
+            self.failures[status] = self.failures.get(status, 0) + 1
+
+    def record_batch(self):
+        """Record a micro-batch being matched."""
+        with self._lock:
+            self.num_batches += 1
+
+    def snapshot(self):
+        """Return a JSON serializable summary of the statistics."""
+        with self._lock:
+            uptime = time.perf_counter() - self.start_time
+            latencies = np.array(self.latencies, dtype=np.float64)
+            summary = {
+                "uptime_s": uptime,
+                "requests": self.num_requests,
+                "colors_matched": self.num_matched,
+                "batches": self.num_batches,
+                "failed_requests": {
+                    str(status): count for status, count in self.failures.items()
+                },
+                "requests_per_batch": self.num_requests / max(self.num_batches, 1),
+                "requests_per_s": self.num_requests / uptime,
+                "colors_per_s": self.num_matched / uptime,
+            }
+        for percentile in (50, 95, 99):
+            summary[f"latency_p{percentile}_ms"] = (
+                float(np.percentile(latencies, percentile)) * 1000
+                if len(latencies)
+                else None
+            )
+        return summary
+
+
+class MatchBatcher:
+    """A MatchBatcher class. This class coalesces concurrent match requests into micro-batches.
+    Requests arriving within window seconds of the first pending request are matched together with a single
+    search_colors call per palette and k, in a background thread.
+    === Class Attributes ===
+    - window: the number of seconds to wait for more requests before matching a batch
+    - max_batch_size: the number of colors at which a batch is matched without waiting for the window to end
+    - stats: the ServerStats to record batches in
+    """
+
+    def __init__(self, window=0.005, max_batch_size=65536, stats=None):
+        """Initialize a new batcher and start its background thread."""
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.stats = stats
+        self._pending = []
+        self._pending_size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, color_palette, rgb_array, k=1):
+        """Queue rgb_array, an (M, 3) array, to be matched against color_palette.
+        Return a Future resolving to the (M, k) index and Delta E 2000 arrays of search_colors.
+        """
+        rgb_array = np.asarray(rgb_array, dtype=np.float64).reshape(-1, 3)
+        future = Future()
+        with self._condition:
+            assert not self._closed, "MatchBatcher is closed"
+            self._pending.append((color_palette, rgb_array, k, future))
+            self._pending_size += len(rgb_array)
+            self._condition.notify()
+        return future
+
+    def close(self):
+        """Match the pending requests and stop the background thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+
+                # give concurrent requests the rest of the window to join the batch
+                deadline = time.perf_counter() + self.window
+                while not self._closed and self._pending_size < self.max_batch_size:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                batch = self._pending
+                self._pending = []
+                self._pending_size = 0
+
+            self._match_batch(batch)
+
+    def _match_batch(self, batch):
+        """Match a batch of requests with one search_colors call per palette and k."""
+        groups = {}
+        for request in batch:
+            color_palette, _, k, future = request
+            # skip requests cancelled after timing out while queued
+            if not future.set_running_or_notify_cancel():
+                continue
+            groups.setdefault((id(color_palette), k), []).append(request)
+
+        for requests in groups.values():
+            color_palette, _, k, _ = requests[0]
+            try:
+                indices, delta_e = color_palette.search_colors(
+                    np.concatenate([rgb_array for _, rgb_array, _, _ in requests]), k=k
+                )
+            except Exception as error:
+                for _, _, _, future in requests:
+                    future.set_exception(error)
+                continue
+
+            if self.stats is not None:
+                self.stats.record_batch()
+            start = 0
+            for _, rgb_array, _, future in requests:
+                end = start + len(rgb_array)
+                future.set_result((indices[start:end], delta_e[start:end]))
+                start = end
+
+
+class MatchingService:
+    """A MatchingService class. This class serves palette matches to the HTTP handler.
+    Palettes are built once per pigment set by the registry and kept in memory between requests.
+    === Class Attributes ===
+    - registry: the PaletteRegistry palettes are built and cached in
+    - stats: the ServerStats of the service
+    - batcher: the MatchBatcher coalescing the match requests
+    - timeout: the number of seconds to wait for a match before failing the request
+    - max_request_size: the maximum number of colors matched per request
+    """
+
+    def __init__(
+        self,
+        registry=palette_registry,
+        window=0.005,
+        max_batch_size=65536,
+        timeout=30,
+        max_request_size=None,
+    ):
+        """Initialize a new matching service, max_request_size defaults to max_batch_size.
+        All matches run on the single batcher thread, so max_request_size bounds how long one request can
+        hold up the others."""
+        self.registry = registry
+        self.stats = ServerStats()
+        self.batcher = MatchBatcher(window, max_batch_size, stats=self.stats)
+        self.timeout = timeout
+        self.max_request_size = (
+            max_request_size if max_request_size is not None else max_batch_size
+        )
+
+    def get_palette(self, source_colors_names, refinement_level=8, custom_colors=None):
+        """Return the palette for the given source colors, which may include custom colors given as a
+        dictionary mapping names to RGB values."""
+        assert (
+            1 <= refinement_level <= MAX_REFINEMENT_LEVEL
+        ), f"refinement_level must be between 1 and {MAX_REFINEMENT_LEVEL}"
+        assert (
+            1 <= len(source_colors_names) <= MAX_SOURCE_COLORS
+        ), f"Between 1 and {MAX_SOURCE_COLORS} source colors must be given"
+        colors = SessionColors()
+        if custom_colors is None:
+            custom_colors = {}
+        assert isinstance(
+            custom_colors, dict
+        ), "custom_colors must map color names to [r, g, b] colors"
+        for name, rgb in custom_colors.items():
+            assert isinstance(name, str), "Custom color names must be strings"
+            assert (
+                isinstance(rgb, (list, tuple))
+                and len(rgb) == 3
+                and all(
+                    isinstance(channel, int)
+                    and not isinstance(channel, bool)
+                    and 0 <= channel <= 255
+                    for channel in rgb
+                )
+            ), f"Custom color {name} must be [r, g, b] with integers in range [0, 255]"
+            colors.add_color(name, rgb)
+        return self.registry.get_palette(
+            source_colors_names, refinement_level=refinement_level, colors=colors
+        )
+
+    def match(self, color_palette, rgb_array, k=1):
+        """Return the (M, k) index and Delta E 2000 arrays of the closest colors in color_palette to rgb_array."""
+        start_time = time.perf_counter()
+        rgb_array = np.asarray(rgb_array, dtype=np.float64)
+        assert (
+            rgb_array.ndim == 2 and rgb_array.shape[1] == 3
+        ), "RGB colors must have shape (M, 3)"
+        assert (
+            (rgb_array >= 0) & (rgb_array <= 255)
+        ).all(), "RGB values must be in range [0, 255]"
+        assert (
+            len(rgb_array) <= self.max_request_size
+        ), f"At most {self.max_request_size} colors can be matched per request"
+        future = self.batcher.submit(color_palette, rgb_array, k)
+        try:
+            indices, delta_e = future.result(self.timeout)
+        except TimeoutError:
+            # drops the request if it is still queued, a running search cannot be interrupted
+            future.cancel()
+            raise
+        self.stats.record_request(len(rgb_array), time.perf_counter() - start_time)
+        return indices, delta_e
+
+    def close(self):
+        """Stop the background matching thread."""
+        self.batcher.close()
+
+
+class MatchingRequestHandler(BaseHTTPRequestHandler):
+    """Handle the JSON endpoints of the matching service.
+    GET /health and GET /stats report the state of the service, POST /match matches a single "rgb" color
+    and POST /match/bulk matches a list of "rgbs" colors. Both POST endpoints take the source color names
+    in "colors" and optionally "k", "refinement_level" and "custom_colors"."""
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            stats = self.server.service.stats.snapshot()
+            stats["palettes"] = len(self.server.service.registry)
+            self._send_json(200, stats)
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path not in ("/match", "/match/bulk"):
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            service = self.server.service
+            color_palette = service.get_palette(
+                body["colors"],
+                refinement_level=int(body.get("refinement_level", 8)),
+                custom_colors=body.get("custom_colors"),
+            )
+            k = int(body.get("k", 1))
+            if self.path == "/match":
+                response = self._match(service, color_palette, body["rgb"], k)
+            else:
+                response = self._match_bulk(service, color_palette, body, k)
+        except (AssertionError, KeyError, TypeError, ValueError) as error:
+            self._send_error(400, f"{type(error).__name__}: {error}")
+            return
+        except TimeoutError:
+            self._send_error(
+                504, f"Matching took longer than {self.server.service.timeout} seconds"
+            )
+            return
+        except Exception as error:
+            # answer unexpected errors too, rather than dropping the connection
+            self._send_error(500, f"{type(error).__name__}: {error}")
+            return
+
+        self._send_json(200, response)
+
+    def _match(self, service, color_palette, rgb, k):
+        assert np.shape(rgb) == (3,), "rgb must be a single [r, g, b] color"
+        indices, delta_e = service.match(color_palette, [rgb], k)
+        return {
+            "matches": [
+                dict(
+                    color_to_json(color_palette.colors[index]), delta_e=float(distance)
+                )
+                for index, distance in zip(indices[0], delta_e[0])
+            ]
+        }
+
+    def _match_bulk(self, service, color_palette, body, k):
+        indices, delta_e = service.match(color_palette, body["rgbs"], k)
+        response = {
+            "indices": indices.tolist(),
+            "delta_e": delta_e.tolist(),
+            "rgb": color_palette.rgb_array[indices].astype(int).tolist(),
+        }
+        if body.get("include_colors", False):
+            response["colors"] = [
+                [color_to_json(color) for color in row]
+                for row in color_palette.get_colors(indices)
+            ]
+        return response
+
+    def _send_error(self, status, message):
+        self.server.service.stats.record_failure(status)
+        self._send_json(status, {"error": message})
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # keep the console quiet, latencies are reported by /stats
+        pass
+
+
+def make_server(host="127.0.0.1", port=8765, service=None):
+    """Return a threaded HTTP server for the matching service, port 0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), MatchingRequestHandler)
+    server.daemon_threads = True
+    server.service = service if service is not None else MatchingService()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve palette matches over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--window-ms",
+        type=float,
+        default=5,
+        help="how long to wait for concurrent requests to join a batch",
+    )
+    parser.add_argument("--max-batch-size", type=int, default=65536)
+    parser.add_argument(
+        "--max-request-size",
+        type=int,
+        default=None,
+        help="the maximum number of colors per request, defaults to --max-batch-size",
+    )
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    service = MatchingService(
+        window=args.window_ms / 1000,
+        max_batch_size=args.max_batch_size,
+        timeout=args.timeout,
+        max_request_size=args.max_request_size,
+    )
+    server = make_server(args.host, args.port, service)
+    print(f"Serving palette matches on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 import streamlit as st
-from color import color_palette, ColorPalette
 from PIL import Image
 import numpy as np
-from resources import available_color_names, named_colors
+from resources import available_color_names
+from registry import SessionColors, palette_registry
+from tiles import TiledImage
 from streamlit_drawable_canvas import st_canvas
 import matplotlib.pyplot as plt
 from io import BytesIO
@@ -60,6 +61,11 @@ if "selected_colors" not in st.session_state:
 if "custom_colors" not in st.session_state:
     st.session_state["custom_colors"] = []
 
+if "session_colors" not in st.session_state:
+    st.session_state["session_colors"] = SessionColors()
+
+session_colors = st.session_state["session_colors"]
+
 all_colors = available_color_names + st.session_state["custom_colors"]
 
 selected_colors = st.multiselect(
@@ -90,7 +96,7 @@ if st.button("Add Custom Color"):
         custom_rgb_tuple = tuple(
             int(custom_color_picker[i : i + 2], 16) for i in (1, 3, 5)
         )
-        named_colors[custom_color_name] = custom_rgb_tuple
+        session_colors.add_color(custom_color_name, custom_rgb_tuple)
         if custom_color_name not in st.session_state["selected_colors"]:
             st.session_state["selected_colors"].append(custom_color_name)
         if custom_color_name not in st.session_state["custom_colors"]:
@@ -101,7 +107,7 @@ if st.session_state["selected_colors"]:
     st.write("###")
     st.write("**Selected Colors:**")
     for color_name in st.session_state["selected_colors"]:
-        color_value = named_colors[color_name]
+        color_value = session_colors[color_name]
         color_hex = f"#{color_value[0]:02x}{color_value[1]:02x}{color_value[2]:02x}"
         st.markdown(
             f"<div style='display: flex; align-items: center;'>"
@@ -111,10 +117,9 @@ if st.session_state["selected_colors"]:
             unsafe_allow_html=True,
         )
 
-    selected_named_colors = {
-        name: named_colors[name] for name in st.session_state["selected_colors"]
-    }
-    color_palette_custom = ColorPalette(selected_named_colors)
+    color_palette_custom = palette_registry.get_palette(
+        st.session_state["selected_colors"], colors=session_colors
+    )
 
     if st.button("Submit Palette"):
         st.session_state["palette_submitted"] = True
@@ -149,8 +154,21 @@ if st.session_state["palette_submitted"]:
     uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "png", "jpeg"])
 
     if uploaded_file is not None:
-        image = Image.open(uploaded_file)
-        img_array = np.array(image)
+        # keep the pixels memory-mapped on disk and only show a downscaled preview,
+        # uploads can be too large to hold in memory
+        # every upload gets a new file_id, even a different file with the same name and size
+        upload_key = uploaded_file.file_id
+        if st.session_state.get("tiled_image_key") != upload_key:
+            if "tiled_image" in st.session_state:
+                st.session_state["tiled_image"].close()
+            uploaded_file.seek(0)
+            tiled_image = TiledImage.from_file(uploaded_file)
+            st.session_state["tiled_image"] = tiled_image
+            st.session_state["tiled_image_key"] = upload_key
+            st.session_state["preview_image"] = tiled_image.preview(preview_size=800)
+        img_array = st.session_state["tiled_image"].array
+        preview_image = st.session_state["preview_image"]
+        preview_scale = img_array.shape[1] / preview_image.size[0]
 
         st.write("###")
         st.write("## Select an area to zoom in:")
@@ -159,10 +177,10 @@ if st.session_state["palette_submitted"]:
             fill_color="rgba(0, 0, 0, 0)",
             stroke_width=3,
             stroke_color="#FF0000",
-            background_image=image,
+            background_image=preview_image,
             update_streamlit=True,
-            height=300,
-            width=image.size[0],
+            height=preview_image.size[1],
+            width=preview_image.size[0],
             drawing_mode="rect",
             key="select_area",
         )
@@ -179,14 +197,15 @@ if st.session_state["palette_submitted"]:
             x2 = x1 + width
             y2 = y1 + height
 
-            center_x = (x1 + x2) // 2
-            center_y = (y1 + y2) // 2
+            # the canvas shows the preview, so scale the selection back to full resolution
+            center_x = int((x1 + x2) / 2 * preview_scale)
+            center_y = int((y1 + y2) / 2 * preview_scale)
             x1 = max(0, center_x - 12)
             y1 = max(0, center_y - 12)
             x2 = min(img_array.shape[1], center_x + 13)
             y2 = min(img_array.shape[0], center_y + 13)
 
-            zoomed_image = Image.fromarray(img_array[y1:y2, x1:x2])
+            zoomed_image = Image.fromarray(np.array(img_array[y1:y2, x1:x2]))
             detailed_zoom_factor = 8
             zoomed_image_large = zoomed_image.resize(
                 (
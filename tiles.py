@@ -0,0 +1,506 @@
+import os
+import tempfile
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+from PIL import Image
+from color import lab_array_to_rgb, rgb_array_to_lab
+from gamut import unique_colors
+
+DEFAULT_TILE_SIZE = 1024
+DEFAULT_PREVIEW_SIZE = 2048
+
+# the palette matched against in each worker process, set by _init_worker
+_worker_palette = None
+
+
+class TiledImage:
+    """A TiledImage class. This class represents an image too large to process in memory at once.
+    The pixels are kept in a memory-mapped .npy file on disk and processed one tile at a time.
+    === Class Attributes ===
+    - path: the path of the (height, width, 3) uint8 .npy file holding the pixels
+    - height: the height of the image in pixels
+    - width: the width of the image in pixels
+    - tile_size: the side length of the square tiles the image is processed in
+    - delete: whether the .npy file is owned by this object and removed by close or when it is garbage collected
+    """
+
+    def __init__(self, path, tile_size=DEFAULT_TILE_SIZE, delete=False):
+        """Initialize a new tiled image from an existing (height, width, 3) uint8 .npy file."""
+        self.path = path
+        self.tile_size = tile_size
+        self.delete = delete
+        # registered first so that the file is removed even if it turns out to be invalid
+        self._finalizer = weakref.finalize(self, _remove_file, path) if delete else None
+        array = self.array
+        assert (
+            array.ndim == 3 and array.shape[2] == 3 and array.dtype == np.uint8
+        ), f"{path} is not a (height, width, 3) uint8 array"
+        self.height, self.width = array.shape[:2]
+
+    @classmethod
+    def from_file(
+        cls, image_file, path=None, tile_size=DEFAULT_TILE_SIZE, strip_height=256
+    ):
+        """Decode an image file into a new .npy file at path, strip by strip.
+        By default the file is a temporary file owned by the returned object, see close.
+        Only the decoder holds the whole image in memory, no full size NumPy copies are made.
+        Images above PIL's Image.MAX_IMAGE_PIXELS are refused as decompression bombs, raise it for large scans.
+        """
+        delete = path is None
+        if delete:
+            with tempfile.NamedTemporaryFile(suffix=".npy", delete=False) as file:
+                path = file.name
+
+        try:
+            with Image.open(image_file) as image:
+                width, height = image.size
+                array = np.lib.format.open_memmap(
+                    path, mode="w+", dtype=np.uint8, shape=(height, width, 3)
+                )
+                for top in range(0, height, strip_height):
+                    bottom = min(top + strip_height, height)
+                    strip = image.crop((0, top, width, bottom)).convert("RGB")
+                    array[top:bottom] = np.asarray(strip)
+                array.flush()
+                del array
+        except BaseException:
+            if delete:
+                _remove_file(path)
+            raise
+
+        return cls(path, tile_size=tile_size, delete=delete)
+
+    def close(self):
+        """Remove the .npy file if it is owned by this object. Memory maps of it must not be used afterwards."""
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def array(self):
+        """Return a read-only memory map of the pixels."""
+        return np.load(self.path, mmap_mode="r")
+
+    def tiles(self):
+        """Return the (top, bottom, left, right) boxes of the tiles covering the image, row by row."""
+        return [
+            (
+                top,
+                min(top + self.tile_size, self.height),
+                left,
+                min(left + self.tile_size, self.width),
+            )
+            for top in range(0, self.height, self.tile_size)
+            for left in range(0, self.width, self.tile_size)
+        ]
+
+    def read_tile(self, box):
+        """Return the pixels inside box as an in-memory array."""
+        top, bottom, left, right = box
+        return np.array(self.array[top:bottom, left:right])
+
+    def preview(self, preview_size=DEFAULT_PREVIEW_SIZE, max_strip_pixels=2**22):
+        """Return a PIL image of the block averages of the image, at most preview_size pixels on its longest side.
+        The image is read in strips of at most max_strip_pixels pixels, so it is never held in memory at once.
+        """
+        block_size = _preview_block_size(self, preview_size)
+        strip_height = block_size * max(
+            1, max_strip_pixels // (self.width * block_size)
+        )
+        array = self.array
+        strips = [
+            _block_average(np.array(array[top : top + strip_height]), block_size)
+            for top in range(0, self.height, strip_height)
+        ]
+        return Image.fromarray(np.concatenate(strips))
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _init_worker(color_palette):
+    global _worker_palette
+    _worker_palette = color_palette
+
+
+def _resolve_workers(max_workers, max_in_flight):
+    """Return the number of worker processes and of tiles in flight, filling in the defaults."""
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2 * max(max_workers, 1)
+    return max_workers, max_in_flight
+
+
+def _make_executor(max_workers, initializer=None, initargs=()):
+    """Return a process pool running initializer in every worker, or None to process tiles in this
+    process if max_workers is 0."""
+    if max_workers == 0:
+        if initializer is not None:
+            initializer(*initargs)
+        return None
+    return ProcessPoolExecutor(
+        max_workers=max_workers, initializer=initializer, initargs=initargs
+    )
+
+
+def _map_tiles(executor, function, tasks, max_in_flight):
+    """Yield the results of function(*task) for each task, in completion order.
+    At most max_in_flight tasks are submitted at once, so only a bounded number of tiles is ever held in memory.
+    """
+    if executor is None:
+        for task in tasks:
+            yield function(*task)
+        return
+
+    in_flight = set()
+    for task in tasks:
+        if len(in_flight) >= max_in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        in_flight.add(executor.submit(function, *task))
+    for future in wait(in_flight).done:
+        yield future.result()
+
+
+def _preview_block_size(tiled_image, preview_size):
+    """Return the block size shrinking the image to at most preview_size pixels on its longest side."""
+    return max(1, -(-max(tiled_image.height, tiled_image.width) // preview_size))
+
+
+def _aligned_tiled_image(tiled_image, block_size):
+    """Return tiled_image with its tile size rounded up to a multiple of block_size, so that blocks never
+    straddle two tiles."""
+    tile_size = -(-tiled_image.tile_size // block_size) * block_size
+    if tile_size == tiled_image.tile_size:
+        return tiled_image
+    return TiledImage(tiled_image.path, tile_size=tile_size)
+
+
+def _block_average(tile, block_size):
+    """Return the mean color of each block_size x block_size block of tile, blocks at the edges may be smaller."""
+    rows = np.arange(0, tile.shape[0], block_size)
+    cols = np.arange(0, tile.shape[1], block_size)
+    sums = np.add.reduceat(
+        np.add.reduceat(tile.astype(np.float64), rows, axis=0), cols, axis=1
+    )
+    row_counts = np.diff(np.append(rows, tile.shape[0]))
+    col_counts = np.diff(np.append(cols, tile.shape[1]))
+    counts = np.outer(row_counts, col_counts)[..., None]
+    return np.round(sums / counts).astype(np.uint8)
+
+
+def _write_block_average(path, box, tile, block_size):
+    """Write the block averages of tile, whose top left corner is aligned to block_size, into the .npy file at path."""
+    top, _, left, _ = box
+    averages = _block_average(tile, block_size)
+    output = np.load(path, mmap_mode="r+")
+    output[
+        top // block_size : top // block_size + averages.shape[0],
+        left // block_size : left // block_size + averages.shape[1],
+    ] = averages
+    output.flush()
+
+
+def _create_npy(path, dtype, shape):
+    """Create a zero filled .npy file at path for the workers to write their tiles into."""
+    array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    array.flush()
+    del array
+
+
+def _save_preview(npy_path, png_path):
+    """Save the (height, width, 3) uint8 array in the .npy file at npy_path as a PNG image."""
+    Image.fromarray(np.asarray(np.load(npy_path, mmap_mode="r"))).save(png_path)
+
+
+def _match_tile(image_path, box, output_paths, block_size):
+    """Match the pixels of one tile against the worker palette and write the results into the output files."""
+    top, bottom, left, right = box
+    tile = np.array(np.load(image_path, mmap_mode="r")[top:bottom, left:right])
+
+    # neighbouring pixels repeat colors a lot, so only match each distinct color once
+    tile_rgb, inverse, _ = unique_colors(tile)
+    indices, delta_e = _worker_palette.search_colors(tile_rgb)
+    tile_indices = indices[inverse, 0].reshape(tile.shape[:2])
+    tile_delta_e = delta_e[inverse, 0].reshape(tile.shape[:2])
+    matched = _worker_palette.rgb_array[tile_indices].astype(np.uint8)
+
+    for name, values in (
+        ("indices", tile_indices),
+        ("delta_e", tile_delta_e),
+        ("matched", matched),
+    ):
+        output = np.load(output_paths[name], mmap_mode="r+")
+        output[top:bottom, left:right] = values
+        output.flush()
+    _write_block_average(output_paths["matched_preview"], box, matched, block_size)
+
+    return float(tile_delta_e.sum()), float(tile_delta_e.max())
+
+
+def match_image(
+    tiled_image,
+    color_palette,
+    output_dir,
+    max_workers=None,
+    max_in_flight=None,
+    preview_size=DEFAULT_PREVIEW_SIZE,
+):
+    """
+    Match every pixel of a tiled image against a color palette, tile by tile across worker processes.
+
+    Args:
+    tiled_image (TiledImage): The image to match.
+    color_palette (ColorPalette): The palette to match against, it is sent once to every worker.
+    output_dir (str): The directory the outputs are written to as the tiles complete.
+    max_workers (int): The number of worker processes, None for one per CPU or 0 to work in this process.
+    max_in_flight (int): The maximum number of tiles submitted at once, twice max_workers by default.
+    preview_size (int): The longest side of the preview image in pixels.
+
+    Returns:
+    dict: The paths of the outputs, "indices" an int32 .npy map of indices into color_palette.colors,
+    "delta_e" a float32 .npy map of Delta E 2000 errors, "matched" a uint8 .npy image of the matched colors
+    and "matched_preview" a downscaled PNG of it, together with the "mean_delta_e" and "max_delta_e" errors.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    max_workers, max_in_flight = _resolve_workers(max_workers, max_in_flight)
+    block_size = _preview_block_size(tiled_image, preview_size)
+    tiled_image = _aligned_tiled_image(tiled_image, block_size)
+    height, width = tiled_image.height, tiled_image.width
+
+    output_paths = {
+        name: os.path.join(output_dir, f"{name}.npy")
+        for name in ("indices", "delta_e", "matched", "matched_preview")
+    }
+    for name, dtype, shape in (
+        ("indices", np.int32, (height, width)),
+        ("delta_e", np.float32, (height, width)),
+        ("matched", np.uint8, (height, width, 3)),
+        (
+            "matched_preview",
+            np.uint8,
+            (-(-height // block_size), -(-width // block_size), 3),
+        ),
+    ):
+        _create_npy(output_paths[name], dtype, shape)
+
+    executor = _make_executor(max_workers, _init_worker, (color_palette,))
+    tasks = [
+        (tiled_image.path, box, output_paths, block_size) for box in tiled_image.tiles()
+    ]
+    delta_e_sum = 0.0
+    max_delta_e = 0.0
+    try:
+        for tile_delta_e_sum, tile_max_delta_e in _map_tiles(
+            executor, _match_tile, tasks, max_in_flight
+        ):
+            delta_e_sum += tile_delta_e_sum
+            max_delta_e = max(max_delta_e, tile_max_delta_e)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    preview_path = os.path.join(output_dir, "matched_preview.png")
+    _save_preview(output_paths["matched_preview"], preview_path)
+
+    return {
+        "indices": output_paths["indices"],
+        "delta_e": output_paths["delta_e"],
+        "matched": output_paths["matched"],
+        "matched_preview": preview_path,
+        "mean_delta_e": delta_e_sum / (height * width),
+        "max_delta_e": max_delta_e,
+    }
+
+
+def _average_tile(image_path, box, averages_path, block_size):
+    """Write the block averages of one tile and return the sum of its pixels."""
+    top, bottom, left, right = box
+    tile = np.array(np.load(image_path, mmap_mode="r")[top:bottom, left:right])
+    _write_block_average(averages_path, box, tile, block_size)
+    return tile.reshape(-1, 3).sum(axis=0, dtype=np.float64)
+
+
+def average_image(
+    tiled_image, output_dir, block_size=16, max_workers=None, max_in_flight=None
+):
+    """
+    Average the colors of a tiled image, over the whole image and over block_size x block_size blocks.
+
+    Args:
+    tiled_image (TiledImage): The image to average.
+    output_dir (str): The directory the outputs are written to as the tiles complete.
+    block_size (int): The side length of the blocks averaged together in the downscaled image.
+    max_workers (int): The number of worker processes, None for one per CPU or 0 to work in this process.
+    max_in_flight (int): The maximum number of tiles submitted at once, twice max_workers by default.
+
+    Returns:
+    dict: The "mean_rgb" of the whole image as a tuple and the paths of the outputs, "averages" a uint8 .npy
+    image of the block averages and "averages_preview" a PNG of it.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    max_workers, max_in_flight = _resolve_workers(max_workers, max_in_flight)
+    tiled_image = _aligned_tiled_image(tiled_image, block_size)
+    height, width = tiled_image.height, tiled_image.width
+
+    averages_path = os.path.join(output_dir, "averages.npy")
+    shape = (-(-height // block_size), -(-width // block_size), 3)
+    _create_npy(averages_path, np.uint8, shape)
+
+    executor = _make_executor(max_workers)
+    tasks = [
+        (tiled_image.path, box, averages_path, block_size)
+        for box in tiled_image.tiles()
+    ]
+    rgb_sum = np.zeros(3, dtype=np.float64)
+    try:
+        for tile_rgb_sum in _map_tiles(executor, _average_tile, tasks, max_in_flight):
+            rgb_sum += tile_rgb_sum
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    preview_path = os.path.join(output_dir, "averages.png")
+    _save_preview(averages_path, preview_path)
+
+    return {
+        "mean_rgb": tuple(float(channel) for channel in rgb_sum / (height * width)),
+        "averages": averages_path,
+        "averages_preview": preview_path,
+    }
+
+
+def _cluster_tile(image_path, box, centers, labels_path=None):
+    """Assign the pixels of one tile to the closest of the LAB centers.
+    Return the per cluster sums of LAB values and pixel counts, and write the labels if labels_path is given.
+    """
+    top, bottom, left, right = box
+    tile = np.array(np.load(image_path, mmap_mode="r")[top:bottom, left:right])
+
+    tile_rgb, inverse, counts = unique_colors(tile)
+    tile_lab = rgb_array_to_lab(tile_rgb)
+    squared_distances = (
+        np.einsum("ij,ij->i", centers, centers) - 2 * tile_lab @ centers.T
+    )
+    labels = np.argmin(squared_distances, axis=1)
+
+    if labels_path is not None:
+        output = np.load(labels_path, mmap_mode="r+")
+        output[top:bottom, left:right] = labels[inverse].reshape(tile.shape[:2])
+        output.flush()
+
+    num_clusters = len(centers)
+    lab_sums = np.stack(
+        [
+            np.bincount(
+                labels, weights=counts * tile_lab[:, channel], minlength=num_clusters
+            )
+            for channel in range(3)
+        ],
+        axis=1,
+    )
+    pixel_counts = np.bincount(labels, weights=counts, minlength=num_clusters)
+    return lab_sums, pixel_counts
+
+
+def cluster_image(
+    tiled_image,
+    output_dir,
+    num_clusters=8,
+    num_iterations=20,
+    tolerance=0.1,
+    sample_size=10000,
+    seed=0,
+    max_workers=None,
+    max_in_flight=None,
+):
+    """
+    Cluster the colors of a tiled image with k-means in LAB color space, streaming over the tiles once per iteration.
+
+    Args:
+    tiled_image (TiledImage): The image to cluster.
+    output_dir (str): The directory the label map is written to as the tiles complete.
+    num_clusters (int): The number of clusters.
+    num_iterations (int): The maximum number of k-means iterations.
+    tolerance (float): The LAB distance all centers must move less than for the clustering to stop early.
+    sample_size (int): The number of random pixels the initial centers are picked from.
+    seed (int): The seed of the random pixel sample.
+    max_workers (int): The number of worker processes, None for one per CPU or 0 to work in this process.
+    max_in_flight (int): The maximum number of tiles submitted at once, twice max_workers by default.
+
+    Returns:
+    dict: The "centers" as a uint8 (num_clusters, 3) RGB array, the "counts" of pixels in each cluster
+    and the path of "labels", an int32 .npy map of the cluster of every pixel.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    max_workers, max_in_flight = _resolve_workers(max_workers, max_in_flight)
+
+    # pick distinct initial centers from a random sample of pixels, reading only the sampled pixels
+    rng = np.random.default_rng(seed)
+    image = tiled_image.array
+    sample = image[
+        rng.integers(0, tiled_image.height, sample_size),
+        rng.integers(0, tiled_image.width, sample_size),
+    ]
+    sample_rgb, _, _ = unique_colors(sample)
+    assert (
+        len(sample_rgb) >= num_clusters
+    ), f"The image sample has fewer than {num_clusters} distinct colors"
+    centers = rgb_array_to_lab(
+        sample_rgb[rng.choice(len(sample_rgb), num_clusters, replace=False)]
+    )
+    del image
+
+    labels_path = os.path.join(output_dir, "labels.npy")
+    _create_npy(labels_path, np.int32, (tiled_image.height, tiled_image.width))
+
+    executor = _make_executor(max_workers)
+    boxes = tiled_image.tiles()
+    try:
+        for _ in range(num_iterations):
+            lab_sums = np.zeros((num_clusters, 3), dtype=np.float64)
+            pixel_counts = np.zeros(num_clusters, dtype=np.float64)
+            tasks = [(tiled_image.path, box, centers) for box in boxes]
+            for tile_lab_sums, tile_pixel_counts in _map_tiles(
+                executor, _cluster_tile, tasks, max_in_flight
+            ):
+                lab_sums += tile_lab_sums
+                pixel_counts += tile_pixel_counts
+
+            # empty clusters keep their previous center
+            new_centers = centers.copy()
+            nonempty = pixel_counts > 0
+            new_centers[nonempty] = lab_sums[nonempty] / pixel_counts[nonempty, None]
+            shift = np.linalg.norm(new_centers - centers, axis=1).max()
+            centers = new_centers
+            if shift < tolerance:
+                break
+
+        # a last pass writes the labels of the final centers
+        tasks = [(tiled_image.path, box, centers, labels_path) for box in boxes]
+        pixel_counts = np.zeros(num_clusters, dtype=np.float64)
+        for _, tile_pixel_counts in _map_tiles(
+            executor, _cluster_tile, tasks, max_in_flight
+        ):
+            pixel_counts += tile_pixel_counts
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return {
+        "centers": lab_array_to_rgb(centers),
+        "counts": pixel_counts.astype(np.int64),
+        "labels": labels_path,
+    }